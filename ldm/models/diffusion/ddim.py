@@ -201,7 +201,9 @@ class DDIMSampler(object):
         if noise_dropout > 0.:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
         x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-        return x_prev, pred_x0
+        # the fp32 schedule tensors promote the update; cast back so the
+        # latent keeps the model dtype across steps when sampling in fp16
+        return x_prev.type(x.dtype), pred_x0
 
     @torch.no_grad()
     def stochastic_encode(self, x0, t, use_original_steps=False, noise=None):
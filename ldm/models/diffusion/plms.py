@@ -213,7 +213,9 @@ class PLMSSampler(object):
             if noise_dropout > 0.:
                 noise = torch.nn.functional.dropout(noise, p=noise_dropout)
             x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-            return x_prev, pred_x0
+            # the fp32 schedule tensors promote the update; cast back so the
+            # latent keeps the model dtype across steps when sampling in fp16
+            return x_prev.type(x.dtype), pred_x0
 
         e_t = get_model_output(x, t)
         if len(old_eps) == 0:
@@ -7,6 +7,10 @@ from einops import rearrange, repeat
 
 from ldm.modules.diffusionmodules.util import checkpoint
 
+# PyTorch 2.0+ ships fused scaled-dot-product attention (FlashAttention-2 on
+# Ampere+), which never materializes the n x n softmax matrix
+_USE_SDPA = hasattr(F, "scaled_dot_product_attention")
+
 
 def exists(val):
     return val is not None
@@ -176,6 +180,14 @@ class CrossAttention(nn.Module):
         v = self.to_v(context)
         del context, x
 
+        if _USE_SDPA and mask is None:
+            # the fused kernel handles the memory problem the manual slicing
+            # below exists for, without the slice-loop overhead
+            q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (q, k, v))
+            out = F.scaled_dot_product_attention(q, k, v, is_causal=False)
+            out = rearrange(out, 'b h n d -> b n (h d)', h=h)
+            return self.to_out(out)
+
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
         r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=q.device)
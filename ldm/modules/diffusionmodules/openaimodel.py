@@ -721,7 +721,9 @@ class UNetModel(nn.Module):
         ), "must specify y if and only if the model is class-conditional"
         hs = []
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
+        # timestep_embedding is always built fp32; match the model dtype so
+        # the time_embed linears accept it when the model runs in fp16
+        emb = self.time_embed(t_emb.type(self.dtype))
 
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
@@ -213,6 +213,10 @@ class SiLU(nn.Module):
 
 class GroupNorm32(nn.GroupNorm):
     def forward(self, x):
+        if self.weight is not None and self.weight.dtype != torch.float32:
+            # the affine params have been cast down (fp16 inference); the
+            # fp32 upcast would mismatch them, so normalize natively
+            return super().forward(x)
         return super().forward(x.float()).type(x.dtype)
 
 def conv_nd(dims, *args, **kwargs):